@@ -1,6 +1,8 @@
 ﻿from flask import Flask, render_template, request, jsonify, Response
 from huggingface_hub import InferenceClient
-import os, re, json, uuid, io, asyncio
+import os, re, json, uuid, io, asyncio, sys, time, threading, functools, hmac, atexit, contextlib, tempfile, hashlib, signal
+from array import array
+from collections import Counter, deque
 import requests as http_req
 try:
     import edge_tts
@@ -198,9 +200,101 @@ MODELS = [
 ]
 
 
+# ── Latency budget: one deadline per turn, split across fallbacks ──────────────
+# A voice turn is /chat followed by /tts. /chat starts the turn clock, spends at
+# most CHAT_BUDGET_SECS of it on the LLM and returns what is left as X-Deadline-Ms;
+# the page echoes that header to /tts, which caps its own budget with it.
+TURN_BUDGET_SECS  = float(os.environ.get("TURN_BUDGET_SECS") or 45)
+CHAT_BUDGET_SECS  = float(os.environ.get("CHAT_BUDGET_SECS") or 35)
+TTS_BUDGET_SECS   = float(os.environ.get("TTS_BUDGET_SECS") or 10)
+MIN_ATTEMPT_SECS  = float(os.environ.get("MIN_ATTEMPT_SECS") or 2)
+DEADLINE_HEADER   = "X-Deadline-Ms"
+CANNED_REPLIES = [
+    "Scusi! The kitchen is a little busy right now — could you say that again?",
+    "Mamma mia, my notepad slipped! One more time, please?",
+    "Sorry, I missed that one — what was it you'd like?",
+]
+
+
+class Deadline:
+    """Wall-clock budget for one request; hands out per-attempt timeouts and times each stage."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.start  = time.monotonic()
+        self.stages = []          # [(name, ms, outcome)]
+
+    def remaining(self):
+        return max(0.0, self.budget - (time.monotonic() - self.start))
+
+    def slice(self, attempts_left):
+        """Timeout for the next attempt, or None if it can't finish in time.
+
+        The current attempt gets everything except MIN_ATTEMPT_SECS per remaining
+        fallback — the primary model is the one expected to answer, so it mustn't
+        be starved by an even split.
+        """
+        rem = self.remaining()
+        if rem < MIN_ATTEMPT_SECS:
+            return None
+        return min(rem, max(MIN_ATTEMPT_SECS, rem - MIN_ATTEMPT_SECS * (max(1, attempts_left) - 1)))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t0 = time.monotonic()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            self.stages.append((name, round((time.monotonic() - t0) * 1000, 1), outcome))
+
+    def skip(self, name):
+        self.stages.append((name, 0.0, "skipped"))
+
+    def server_timing(self):
+        """Stage durations as a Server-Timing header value (visible in browser devtools)."""
+        parts = [f'{re.sub(r"[^A-Za-z0-9_-]", "-", n)};desc="{o}";dur={ms}' for n, ms, o in self.stages]
+        parts.append(f"total;dur={round((time.monotonic() - self.start) * 1000, 1)}")
+        return ", ".join(parts)
+
+    def log(self, label):
+        used = time.monotonic() - self.start
+        detail = " ".join(f"{n}={ms:.0f}ms/{o}" for n, ms, o in self.stages)
+        print(f"[BUDGET] {label} used {used:.2f}s of {self.budget:.0f}s — {detail}", flush=True)
+
+
+def _call_with_timeout(fn, timeout):
+    """Run fn() with a wall-clock limit; raise TimeoutError if it isn't done in `timeout` s.
+
+    Client-side timeouts (requests, InferenceClient) only bound connect and each
+    gap between reads, so a trickling response could outlive its share. The call
+    runs in a daemon thread; on timeout it is abandoned (it ends at its own socket
+    timeout) and the turn moves on to the next fallback.
+    """
+    box = {}
+
+    def run():
+        try:
+            box["result"] = fn()
+        except BaseException as e:
+            box["error"] = e
+
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    worker.join(timeout)
+    if worker.is_alive():
+        raise TimeoutError(f"no result within {timeout:.1f}s")
+    if "error" in box:
+        raise box["error"]
+    return box["result"]
+
+
 def _build_prompt(history):
     """Plain-text prompt for models that only support text_generation."""
-    parts = [f"[SYSTEM]\n{SYSTEM}\n"]
+    parts = [f"[SYSTEM]\n{system_prompt()}\n"]
     for msg in history:
         role = "User" if msg["role"] == "user" else "Pino"
         parts.append(f"{role}: {msg['content']}")
@@ -208,9 +302,7 @@ def _build_prompt(history):
     return "\n".join(parts)
 
 
-def chat_with_llm(history):
-    import sys
-
+def chat_with_llm(history, deadline=None):
     # HF Spaces auto-injects HUGGING_FACE_HUB_TOKEN; also accept manual HF_TOKEN secret
     hf_token_raw   = os.environ.get("HF_TOKEN") or ""
     hfhub_token_raw = os.environ.get("HUGGING_FACE_HUB_TOKEN") or ""
@@ -224,36 +316,44 @@ def chat_with_llm(history):
     if not token:
         return "⚠️ No HuggingFace token found. Add HF_TOKEN in Space Settings → Secrets."
 
+    deadline = deadline or Deadline(CHAT_BUDGET_SECS)
     trimmed  = history[-20:]
-    messages = [{"role": "system", "content": SYSTEM}] + trimmed
-    client   = InferenceClient(token=token)
+    messages = [{"role": "system", "content": system_prompt()}] + trimmed
     last_err = "Unknown error"
 
-    for model_id, supports_chat in MODELS:
-        print(f"[DEBUG] Trying model: {model_id} (chat={supports_chat})", flush=True)
+    for n, (model_id, supports_chat) in enumerate(MODELS):
+        stage   = "llm:" + model_id.split("/")[-1]
+        timeout = deadline.slice(len(MODELS) - n)
+        if timeout is None:
+            print(f"[DEBUG] ⏱️ Budget exhausted — skipping {model_id} and the rest", flush=True)
+            deadline.skip(stage)
+            return random.choice(CANNED_REPLIES)
+        print(f"[DEBUG] Trying model: {model_id} (chat={supports_chat}, timeout={timeout:.1f}s)", flush=True)
+        client = InferenceClient(token=token, timeout=timeout)
         try:
-            if supports_chat:
-                resp = client.chat_completion(
-                    model=model_id,
-                    messages=messages,
-                    max_tokens=180,
-                    temperature=0.75,
-                )
-                result = resp.choices[0].message.content.strip()
-                print(f"[DEBUG] ✅ Success with {model_id} — response length: {len(result)}", flush=True)
-                return result
-            else:
-                prompt = _build_prompt(trimmed)
-                resp   = client.text_generation(
-                    prompt,
-                    model=model_id,
-                    max_new_tokens=150,
-                    temperature=0.75,
-                    stop_sequences=["User:", "[SYSTEM]"],
-                )
-                result = resp.split("User:")[0].strip()
-                print(f"[DEBUG] ✅ Success with {model_id} — response length: {len(result)}", flush=True)
-                return result
+            with deadline.stage(stage):
+                if supports_chat:
+                    resp = _call_with_timeout(lambda: client.chat_completion(
+                        model=model_id,
+                        messages=messages,
+                        max_tokens=180,
+                        temperature=0.75,
+                    ), timeout)
+                    result = resp.choices[0].message.content.strip()
+                    print(f"[DEBUG] ✅ Success with {model_id} — response length: {len(result)}", flush=True)
+                    return result
+                else:
+                    prompt = _build_prompt(trimmed)
+                    resp   = _call_with_timeout(lambda: client.text_generation(
+                        prompt,
+                        model=model_id,
+                        max_new_tokens=150,
+                        temperature=0.75,
+                        stop_sequences=["User:", "[SYSTEM]"],
+                    ), timeout)
+                    result = resp.split("User:")[0].strip()
+                    print(f"[DEBUG] ✅ Success with {model_id} — response length: {len(result)}", flush=True)
+                    return result
 
         except Exception as e:
             last_err = str(e)
@@ -261,6 +361,8 @@ def chat_with_llm(history):
             continue
 
     print(f"[DEBUG] 🚨 All models exhausted. Last error: {last_err[:300]}", flush=True)
+    if deadline.remaining() < MIN_ATTEMPT_SECS:
+        return random.choice(CANNED_REPLIES)
     return f"⚠️ All models failed. Last error: {last_err[:200]}"
 
 
@@ -408,6 +510,8 @@ def _pick(val, catalogue, default_key):
     if not val:
         return catalogue[default_key]
     v = val.lower().strip()
+    if v in catalogue:        # exact key first, so "large" isn't caught by "extra large"
+        return catalogue[v]
     for k in sorted(catalogue, key=len, reverse=True):
         if k in v or v in k:
             return catalogue[k]
@@ -444,13 +548,13 @@ def build_receipt(order_data):
         il = item.lower().strip()
         if not il or il == "none":
             continue
-        for k in sorted(DRINKS_MAP, key=len, reverse=True):
-            if k in il or il in k:
-                lbl, emoji, price = DRINKS_MAP[k]
-                if lbl not in seen_drinks:
-                    seen_drinks.add(lbl)
-                    drinks_out.append({"label": lbl, "emoji": emoji, "price": price})
-                break
+        match = il if il in DRINKS_MAP else next(
+            (k for k in sorted(DRINKS_MAP, key=len, reverse=True) if k in il or il in k), None)
+        if match:
+            lbl, emoji, price = DRINKS_MAP[match]
+            if lbl not in seen_drinks:
+                seen_drinks.add(lbl)
+                drinks_out.append({"label": lbl, "emoji": emoji, "price": price})
 
     raw_ex = order_data.get("extras", [])
     if isinstance(raw_ex, str):
@@ -515,6 +619,376 @@ def build_receipt(order_data):
     }
 
 
+# ── Order analytics (streaming aggregates) ─────────────────────────────────────
+# Every confirmed receipt bumps a few fixed-size arrays indexed by catalogue label,
+# so updates are O(items in the order) and reports never rescan past orders.
+# State is checkpointed to STATS_PATH after every recorded order (orders are rare
+# and the file is tiny) and reloaded at startup. /stats needs
+# "X-Admin-Token: <STATS_TOKEN>"; recommendation_hints() is the only open view.
+STATS_PATH         = os.environ.get("STATS_PATH") or "/tmp/pizzavoice_stats.json"
+STATS_TOKEN        = (os.environ.get("STATS_TOKEN") or "").strip()
+STATS_DEDUP_WINDOW = int(os.environ.get("STATS_DEDUP_WINDOW") or 1000)
+
+
+def _labels(catalogue):
+    return sorted({v[0] for v in catalogue.values()})
+
+
+class OrderStats:
+    """Array-backed counters for orders, pairings, size/crust combos and revenue."""
+
+    def __init__(self):
+        self.toppings = _labels(TOPPINGS_MAP)
+        self.drinks   = _labels(DRINKS_MAP)
+        self.sizes    = _labels(SIZES_MAP)
+        self.crusts   = _labels(CRUSTS_MAP)
+        self._t_idx = {l: i for i, l in enumerate(self.toppings)}
+        self._d_idx = {l: i for i, l in enumerate(self.drinks)}
+        self._s_idx = {l: i for i, l in enumerate(self.sizes)}
+        self._c_idx = {l: i for i, l in enumerate(self.crusts)}
+        self._lock    = threading.Lock()
+        self._io_lock = threading.Lock()      # one checkpoint writer at a time
+        self._dirty   = False
+        self._seen      = set()               # keys of recently recorded orders
+        self._seen_fifo = deque()
+        self.reset()
+
+    def reset(self):
+        nt, nd = len(self.toppings), len(self.drinks)
+        self.orders        = 0
+        self.items         = 0
+        self.revenue       = 0.0
+        self.topping_count = array("l", [0] * nt)
+        self.drink_count   = array("l", [0] * nd)
+        self.pairs         = array("l", [0] * (nt * nd))   # topping × drink, row-major
+        self.combos        = array("l", [0] * (len(self.sizes) * len(self.crusts)))
+        self.hour_revenue  = array("d", [0.0] * 24)
+        self.hour_orders   = array("l", [0] * 24)
+
+    # ── updates ──
+    def record(self, receipt, when=None):
+        """Count a confirmed order once; returns False if it was already recorded.
+
+        The LLM may re-emit ##ORDER## on later turns of the same conversation, so
+        orders are keyed by their normalised content (incl. name and address).
+        """
+        order = receipt["order"]
+        key   = hashlib.sha1(json.dumps(order, sort_keys=True).encode()).hexdigest()
+        total = receipt["pricing"]["total"]
+        hour  = (when or datetime.now()).hour
+        tops   = [self._t_idx[t["label"]] for t in order["toppings"] if t["label"] in self._t_idx]
+        drinks = [self._d_idx[d["label"]] for d in order["drinks"]   if d["label"] in self._d_idx]
+        s = self._s_idx.get(order["size"]["label"])
+        c = self._c_idx.get(order["crust"]["label"])
+        nd = len(self.drinks)
+
+        with self._lock:
+            if key in self._seen:
+                return False
+            self._seen.add(key)
+            self._seen_fifo.append(key)
+            if len(self._seen_fifo) > STATS_DEDUP_WINDOW:
+                self._seen.discard(self._seen_fifo.popleft())
+            self.orders  += 1
+            self.items   += order["quantity"] + len(drinks)
+            self.revenue += total
+            self.hour_revenue[hour] += total
+            self.hour_orders[hour]  += 1
+            if s is not None and c is not None:
+                self.combos[s * len(self.crusts) + c] += 1
+            for t in tops:
+                self.topping_count[t] += 1
+                for d in drinks:
+                    self.pairs[t * nd + d] += 1
+            for d in drinks:
+                self.drink_count[d] += 1
+            self._dirty = True
+        self.checkpoint()
+        return True
+
+    # ── reporting ──
+    def _top(self, counts, labels, n):
+        ranked = sorted(range(len(counts)), key=lambda i: counts[i], reverse=True)
+        return [{"label": labels[i], "count": counts[i]} for i in ranked[:n] if counts[i]]
+
+    def top_pairings(self, n=5):
+        nd = len(self.drinks)
+        ranked = sorted(range(len(self.pairs)), key=lambda i: self.pairs[i], reverse=True)
+        return [{"topping": self.toppings[i // nd], "drink": self.drinks[i % nd], "count": self.pairs[i]}
+                for i in ranked[:n] if self.pairs[i]]
+
+    def top_combos(self, n=5):
+        nc = len(self.crusts)
+        ranked = sorted(range(len(self.combos)), key=lambda i: self.combos[i], reverse=True)
+        return [{"size": self.sizes[i // nc], "crust": self.crusts[i % nc], "count": self.combos[i]}
+                for i in ranked[:n] if self.combos[i]]
+
+    def snapshot(self):
+        with self._lock:
+            orders = self.orders
+            return {
+                "orders":           orders,
+                "revenue":          round(self.revenue, 2),
+                "avg_basket_items": round(self.items / orders, 2) if orders else 0.0,
+                "avg_basket_total": round(self.revenue / orders, 2) if orders else 0.0,
+                "top_toppings":     self._top(self.topping_count, self.toppings, 5),
+                "top_drinks":       self._top(self.drink_count, self.drinks, 5),
+                "top_pairings":     self.top_pairings(),
+                "top_combos":       self.top_combos(),
+                "revenue_by_hour":  [round(x, 2) for x in self.hour_revenue],
+                "orders_by_hour":   list(self.hour_orders),
+            }
+
+    def prompt_hints(self, min_orders=5):
+        """Short plain-text block of house favourites for the system prompt ('' if too little data).
+
+        Caveat: /chat is unauthenticated, so a scripted client placing many distinct
+        orders can skew these favourites for every customer. Dedup only stops
+        repeats of the same order; keep the wording advisory.
+        """
+        with self._lock:
+            if self.orders < min_orders:
+                return ""
+            combos   = self.top_combos(2)
+            pairings = self.top_pairings(3)
+            toppings = self._top(self.topping_count, self.toppings, 3)
+        lines = ["HOUSE FAVOURITES (from real orders — use for recommendations and drink pairings):"]
+        if combos:
+            lines.append("  Popular builds: " + " | ".join(f"{c['size']} + {c['crust']}" for c in combos))
+        if toppings:
+            lines.append("  Top toppings:   " + ", ".join(t["label"] for t in toppings))
+        if pairings:
+            lines.append("  Pairings:       " + " | ".join(f"{p['topping']} → {p['drink']}" for p in pairings))
+        return "\n".join(lines) if len(lines) > 1 else ""
+
+    # ── persistence ──
+    def _to_dict(self):
+        return {
+            "orders": self.orders, "items": self.items, "revenue": self.revenue,
+            "toppings": self.toppings, "drinks": self.drinks,
+            "sizes": self.sizes, "crusts": self.crusts,
+            "topping_count": list(self.topping_count), "drink_count": list(self.drink_count),
+            "pairs": list(self.pairs), "combos": list(self.combos),
+            "hour_revenue": list(self.hour_revenue), "hour_orders": list(self.hour_orders),
+        }
+
+    def checkpoint(self, path=STATS_PATH):
+        # Snapshot under _io_lock so a later snapshot is never overwritten by an older one
+        with self._io_lock:
+            with self._lock:
+                data = self._to_dict()
+                self._dirty = False
+            tmp = None
+            try:
+                with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False,
+                                                 dir=os.path.dirname(path) or ".",
+                                                 prefix=".stats-", suffix=".tmp") as f:
+                    tmp = f.name
+                    json.dump(data, f)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"[STATS] Checkpoint failed: {str(e)[:200]}", flush=True)
+                with self._lock:
+                    self._dirty = True
+                if tmp and os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def flush(self):
+        """Checkpoint only if something changed since the last write (exit / SIGTERM)."""
+        if self._dirty:
+            self.checkpoint()
+
+    def load(self, path=STATS_PATH):
+        """Restore from a checkpoint, remapping by label so menu edits don't corrupt counts."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        if not isinstance(data, dict):
+            print(f"[STATS] Ignoring bad checkpoint {path}: not a JSON object", flush=True)
+            return
+
+        def remap_1d(dst, idx, labels, values):
+            for l, v in zip(labels, values):
+                if l in idx:
+                    dst[idx[l]] = v
+
+        def remap_2d(dst, ri, ci, rows, cols, values):
+            ncols = len(cols)
+            for r, rl in enumerate(rows):
+                for c, cl in enumerate(cols):
+                    if rl in ri and cl in ci:
+                        dst[ri[rl] * len(ci) + ci[cl]] = values[r * ncols + c]
+
+        with self._lock:
+            self.reset()
+            try:
+                self.orders  = int(data.get("orders", 0))
+                self.items   = int(data.get("items", 0))
+                self.revenue = float(data.get("revenue", 0.0))
+                remap_1d(self.topping_count, self._t_idx, data["toppings"], data["topping_count"])
+                remap_1d(self.drink_count,   self._d_idx, data["drinks"],   data["drink_count"])
+                remap_2d(self.pairs,  self._t_idx, self._d_idx, data["toppings"], data["drinks"], data["pairs"])
+                remap_2d(self.combos, self._s_idx, self._c_idx, data["sizes"],    data["crusts"], data["combos"])
+                for h in range(24):
+                    self.hour_revenue[h] = data["hour_revenue"][h]
+                    self.hour_orders[h]  = data["hour_orders"][h]
+            except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+                print(f"[STATS] Ignoring bad checkpoint {path}: {str(e)[:200]}", flush=True)
+                self.reset()
+                return
+        print(f"[STATS] Restored {self.orders} orders from {path}", flush=True)
+
+
+order_stats = OrderStats()
+
+
+def init_stats():
+    """Restore stats from disk and flush them at exit; called at server startup, not import."""
+    order_stats.load()
+    atexit.register(order_stats.flush)
+
+    # `docker stop` sends SIGTERM to PID 1 (python app.py); without a handler atexit never runs
+    def _on_sigterm(signum, frame):
+        order_stats.flush()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, _on_sigterm)
+
+
+def recommendation_hints():
+    """House-favourites text for the prompt builder, derived from live order stats."""
+    return order_stats.prompt_hints()
+
+
+def system_prompt():
+    hints = recommendation_hints()
+    return f"{SYSTEM}\n{hints}\n" if hints else SYSTEM
+
+
+# ── On-demand request profiling (opt-in) ───────────────────────────────────────
+# PROFILE_ENABLED=1 turns it on; otherwise @profiled returns the view untouched.
+# A request is profiled when random() < PROFILE_SAMPLE_RATE, or when it carries
+# "X-Profile: <PROFILE_TOKEN>". Profiles are folded stacks (flamegraph.pl /
+# speedscope format) kept in a bounded ring buffer, served under /admin/profiles
+# to "X-Admin-Token: <PROFILE_ADMIN_TOKEN>" — a separate secret, so whoever may
+# trigger a capture can't read everyone else's.
+PROFILE_ENABLED     = os.environ.get("PROFILE_ENABLED", "").strip().lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE") or 0.0)
+PROFILE_INTERVAL    = max(1.0, float(os.environ.get("PROFILE_INTERVAL_MS") or 5)) / 1000
+PROFILE_TOKEN       = (os.environ.get("PROFILE_TOKEN") or "").strip()
+PROFILE_ADMIN_TOKEN = (os.environ.get("PROFILE_ADMIN_TOKEN") or "").strip()
+PROFILE_HEADER      = "X-Profile"
+_profiles      = deque(maxlen=int(os.environ.get("PROFILE_BUFFER") or 50))
+_profiles_lock = threading.Lock()
+
+
+class _StackSampler:
+    """Samples one thread's Python stack on a timer into folded-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval  = interval
+        self.counts    = Counter()
+        self.samples   = 0
+        self._stop     = threading.Event()
+        self._thread   = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        return "\n".join(f"{stack} {n}" for stack, n in self.counts.most_common())
+
+
+def profiled(view):
+    """Wrap a view with the sampling profiler; a no-op when profiling is disabled."""
+    if not PROFILE_ENABLED:
+        return view
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        forced = bool(PROFILE_TOKEN) and hmac.compare_digest(
+            request.headers.get(PROFILE_HEADER, ""), PROFILE_TOKEN)
+        if not forced and random.random() >= PROFILE_SAMPLE_RATE:
+            return view(*args, **kwargs)
+
+        sampler = _StackSampler(threading.get_ident(), PROFILE_INTERVAL)
+        started = datetime.now()
+        t0      = time.perf_counter()
+        sampler.start()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            sampler.stop()
+            entry = {
+                "id":          uuid.uuid4().hex[:12],
+                "endpoint":    request.path,
+                "started":     started.isoformat(timespec="seconds"),
+                "duration_ms": round((time.perf_counter() - t0) * 1000, 1),
+                "samples":     sampler.samples,
+                "forced":      forced,
+                "folded":      sampler.folded(),
+            }
+            with _profiles_lock:
+                _profiles.append(entry)
+            print(f"[PROFILE] {entry['id']} {entry['endpoint']} "
+                  f"{entry['duration_ms']}ms ({entry['samples']} samples)", flush=True)
+
+    return wrapper
+
+
+def _profile_admin_error():
+    """Return an error response unless the caller presented the admin token."""
+    if not (PROFILE_ENABLED and PROFILE_ADMIN_TOKEN):
+        return Response(b"", status=404)
+    given = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(given, PROFILE_ADMIN_TOKEN):
+        return Response(b"", status=403)
+    return None
+
+
+@app.route("/admin/profiles")
+def list_profiles():
+    err = _profile_admin_error()
+    if err:
+        return err
+    with _profiles_lock:
+        items = [{k: v for k, v in p.items() if k != "folded"} for p in _profiles]
+    return jsonify({"enabled": PROFILE_ENABLED, "sample_rate": PROFILE_SAMPLE_RATE,
+                    "capacity": _profiles.maxlen, "profiles": items[::-1]})
+
+
+@app.route("/admin/profiles/<pid>")
+def download_profile(pid):
+    err = _profile_admin_error()
+    if err:
+        return err
+    with _profiles_lock:
+        match = next((p for p in _profiles if p["id"] == pid), None)
+    if not match:
+        return Response(b"", status=404)
+    return Response(match["folded"], mimetype="text/plain",
+                    headers={"Content-Disposition": f"attachment; filename=profile-{pid}.folded"})
+
+
 # ── Natural TTS (Edge TTS primary → HF Inference fallback) ────────────────────
 EDGE_VOICE = "en-US-JennyNeural"          # warm, natural Microsoft Neural voice
 HF_TTS_MODELS = [
@@ -523,8 +997,8 @@ HF_TTS_MODELS = [
 ]
 
 
-def _edge_tts_sync(text, voice=EDGE_VOICE):
-    """Run Edge TTS and return MP3 bytes synchronously."""
+def _edge_tts_sync(text, voice=EDGE_VOICE, timeout=None):
+    """Run Edge TTS and return MP3 bytes synchronously (TimeoutError past `timeout` s)."""
     async def _generate():
         comm = edge_tts.Communicate(text, voice)
         buf = b""
@@ -535,12 +1009,13 @@ def _edge_tts_sync(text, voice=EDGE_VOICE):
 
     loop = asyncio.new_event_loop()
     try:
-        return loop.run_until_complete(_generate())
+        return loop.run_until_complete(asyncio.wait_for(_generate(), timeout))
     finally:
         loop.close()
 
 
 @app.route("/tts", methods=["POST"])
+@profiled
 def tts():
     """Natural speech: Edge TTS (Microsoft Neural) → HF Inference → 503."""
     data = request.get_json(force=True)
@@ -555,59 +1030,108 @@ def tts():
     if len(clean) > 500:
         clean = clean[:500]
 
+    # Within a voice turn /chat hands over what's left of the turn budget
+    budget = TTS_BUDGET_SECS
+    try:
+        budget = min(budget, max(0.0, float(request.headers[DEADLINE_HEADER]) / 1000))
+    except (KeyError, ValueError):
+        pass
+    deadline = Deadline(budget)
+    token = (os.environ.get("HF_TOKEN")
+             or os.environ.get("HUGGING_FACE_HUB_TOKEN") or "").strip()
+    hf_models = HF_TTS_MODELS if token else []
+    attempts  = (1 if edge_tts else 0) + len(hf_models)
+
+    def _audio(body, mimetype):
+        deadline.log("/tts")
+        return Response(body, mimetype=mimetype,
+                        headers={"Cache-Control": "no-cache",
+                                 "Server-Timing": deadline.server_timing()})
+
     # 1) Edge TTS — very natural Microsoft Neural voices (free)
     if edge_tts:
-        try:
-            audio = _edge_tts_sync(clean)
-            if len(audio) > 100:
-                return Response(audio, mimetype="audio/mpeg",
-                                headers={"Cache-Control": "no-cache"})
-        except Exception as e:
-            print(f"[TTS] Edge failed: {str(e)[:200]}", flush=True)
+        timeout = deadline.slice(attempts)
+        attempts -= 1
+        if timeout is None:
+            deadline.skip("tts:edge")
+        else:
+            try:
+                with deadline.stage("tts:edge"):
+                    audio = _edge_tts_sync(clean, timeout=timeout)
+                if len(audio) > 100:
+                    return _audio(audio, "audio/mpeg")
+            except Exception as e:
+                print(f"[TTS] Edge failed: {str(e)[:200] or type(e).__name__}", flush=True)
 
     # 2) HF Inference API direct REST as fallback
-    token = (os.environ.get("HF_TOKEN")
-             or os.environ.get("HUGGING_FACE_HUB_TOKEN") or "").strip()
-    if token:
-        for mid in HF_TTS_MODELS:
-            try:
-                r = http_req.post(
+    for mid in hf_models:
+        stage   = "tts:" + mid.split("/")[-1]
+        timeout = deadline.slice(attempts)
+        attempts -= 1
+        if timeout is None:
+            deadline.skip(stage)
+            continue
+        try:
+            with deadline.stage(stage):
+                r = _call_with_timeout(lambda: http_req.post(
                     f"https://api-inference.huggingface.co/models/{mid}",
                     headers={"Authorization": f"Bearer {token}"},
                     json={"inputs": clean,
                           "options": {"wait_for_model": True}},
-                    timeout=30,
-                )
-                if r.status_code == 200 and len(r.content) > 100:
-                    ct = r.headers.get("content-type", "audio/flac")
-                    return Response(r.content, mimetype=ct,
-                                    headers={"Cache-Control": "no-cache"})
-            except Exception as e:
-                print(f"[TTS] HF {mid}: {str(e)[:200]}", flush=True)
+                    timeout=timeout,
+                ), timeout)
+            if r.status_code == 200 and len(r.content) > 100:
+                return _audio(r.content, r.headers.get("content-type", "audio/flac"))
+        except Exception as e:
+            print(f"[TTS] HF {mid}: {str(e)[:200]}", flush=True)
 
-    return Response(b"", status=503)
+    # Out of options or out of time — the client falls back to browser speechSynthesis
+    deadline.log("/tts")
+    return Response(b"", status=503,
+                    headers={"Server-Timing": deadline.server_timing()})
 
 
 # ── Routes ─────────────────────────────────────────────────────────────────────
 @app.route("/")
 def index():
-    return render_template("index.html")
+    return render_template("index.html", tts_timeout_ms=int(TTS_BUDGET_SECS * 1000) + 1000)
 
 
 @app.route("/chat", methods=["POST"])
+@profiled
 def chat():
+    deadline    = Deadline(min(CHAT_BUDGET_SECS, TURN_BUDGET_SECS))
     data        = request.get_json(force=True)
     history     = data.get("history", [])
-    reply       = chat_with_llm(history)
-    reply, order_data = extract_order(reply)
-    reply, update_data = extract_update(reply)
-    # Fallback: infer partial from conversation if LLM didn't include UPDATE
-    inferred = infer_partial(history)
-    partial  = merge_partial(update_data, inferred)
-    receipt  = build_receipt(order_data) if order_data else None
-    return jsonify({"reply": reply, "partial": partial, "receipt": receipt})
+    reply       = chat_with_llm(history, deadline)
+    with deadline.stage("parse"):
+        reply, order_data = extract_order(reply)
+        reply, update_data = extract_update(reply)
+        # Fallback: infer partial from conversation if LLM didn't include UPDATE
+        inferred = infer_partial(history)
+        partial  = merge_partial(update_data, inferred)
+    with deadline.stage("receipt"):
+        receipt  = build_receipt(order_data) if order_data else None
+        if receipt:
+            order_stats.record(receipt)
+    deadline.log("/chat")
+    turn_left = max(0.0, TURN_BUDGET_SECS - (time.monotonic() - deadline.start))
+    resp = jsonify({"reply": reply, "partial": partial, "receipt": receipt})
+    resp.headers["Server-Timing"] = deadline.server_timing()
+    resp.headers[DEADLINE_HEADER] = str(int(turn_left * 1000))
+    return resp
+
+
+@app.route("/stats")
+def stats():
+    if not STATS_TOKEN:
+        return Response(b"", status=404)
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), STATS_TOKEN):
+        return Response(b"", status=403)
+    return jsonify(order_stats.snapshot())
 
 
 if __name__ == "__main__":
     print(f"\n===== Application Startup at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} =====")
+    init_stats()
     app.run(host="0.0.0.0", port=7860, debug=False)
\ No newline at end of file